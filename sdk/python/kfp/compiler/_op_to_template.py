@@ -46,6 +46,8 @@ def _process_obj(obj: Any, map_to_tmpl_var: dict):
         # replace all unsanitized signature with template var
         for param_tuple in param_tuples:
             obj = re.sub(param_tuple.pattern, map_to_tmpl_var[param_tuple.pattern], obj)
+        # still a str, none of the checks below apply
+        return obj
 
     # list
     if isinstance(obj, list):
@@ -14,7 +14,10 @@
 
 import kfp
 import kfp.compiler as compiler
+import kfp.compiler.main as compiler_main
 import kfp.dsl as dsl
+import functools
+import importlib
 import os
 import shutil
 import subprocess
@@ -30,9 +33,38 @@ from kfp.dsl import ContainerOp, pipeline
 from kfp.dsl.types import Integer, InconsistentTypeException
 from kubernetes.client import V1Toleration
 
+try:
+  from yaml import CSafeLoader as SafeLoader
+except ImportError:
+  from yaml import SafeLoader
+
+_TEST_DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'testdata')
+if _TEST_DATA_DIR not in sys.path:
+  sys.path.insert(0, _TEST_DATA_DIR)
+
+
+def _safe_load(stream):
+  return yaml.load(stream, Loader=SafeLoader)
+
 
 class TestCompiler(unittest.TestCase):
 
+  @classmethod
+  def setUpClass(cls):
+    cls._tmp_root = tempfile.mkdtemp(prefix='kfp-compiler-tests-')
+    cls._basic = importlib.import_module('basic')
+    cls._compose = importlib.import_module('compose')
+
+  @classmethod
+  def tearDownClass(cls):
+    # Comment next line for gathering golden yaml from the compiled outputs.
+    shutil.rmtree(cls._tmp_root, ignore_errors=True)
+
+  def _make_tmpdir(self):
+    tmpdir = os.path.join(self._tmp_root, self._testMethodName)
+    os.makedirs(tmpdir, exist_ok=True)
+    return tmpdir
+
   def test_operator_to_template(self):
     """Test converting operator to template"""
 
@@ -147,228 +179,182 @@ class TestCompiler(unittest.TestCase):
     self.assertEqual(golden_output, compiler._op_to_template._op_to_template(op))
     self.assertEqual(res_output, compiler._op_to_template._op_to_template(res))
 
+  @staticmethod
+  @functools.lru_cache(maxsize=None)
+  def _load_golden(golden_file):
+    # Goldens are shared between tests, so callers must not mutate the result.
+    with open(golden_file, 'r') as f:
+      return _safe_load(f)
+
   def _get_yaml_from_zip(self, zip_file):
     with zipfile.ZipFile(zip_file, 'r') as zip:
-      with open(zip.extract(zip.namelist()[0]), 'r') as yaml_file:
-        return yaml.safe_load(yaml_file)
+      return _safe_load(zip.read(zip.namelist()[0]))
 
   def _get_yaml_from_tar(self, tar_file):
     with tarfile.open(tar_file, 'r:gz') as tar:
-      return yaml.safe_load(tar.extractfile(tar.getmembers()[0]))
+      return _safe_load(tar.extractfile(tar.getmembers()[0]))
+
+  def _get_yaml_from_file(self, yaml_file):
+    with open(yaml_file, 'r') as f:
+      return _safe_load(f)
 
   def test_basic_workflow(self):
     """Test compiling a basic workflow."""
 
-    test_data_dir = os.path.join(os.path.dirname(__file__), 'testdata')
-    sys.path.append(test_data_dir)
-    import basic
-    tmpdir = tempfile.mkdtemp()
-    package_path = os.path.join(tmpdir, 'workflow.zip')
-    try:
-      compiler.Compiler().compile(basic.save_most_frequent_word, package_path)
-      with open(os.path.join(test_data_dir, 'basic.yaml'), 'r') as f:
-        golden = yaml.safe_load(f)
-      compiled = self._get_yaml_from_zip(package_path)
-
-      self.maxDiff = None
-      # Comment next line for generating golden yaml.
-      self.assertEqual(golden, compiled)
-    finally:
-      # Replace next line with commented line for gathering golden yaml.
-      shutil.rmtree(tmpdir)
-      # print(tmpdir)
+    compiled = compiler.Compiler()._compile(self._basic.save_most_frequent_word)
+    golden = self._load_golden(os.path.join(_TEST_DATA_DIR, 'basic.yaml'))
+
+    self.maxDiff = None
+    self.assertEqual(golden, compiled)
 
   def test_composing_workflow(self):
     """Test compiling a simple workflow, and a bigger one composed from the simple one."""
 
-    test_data_dir = os.path.join(os.path.dirname(__file__), 'testdata')
-    sys.path.append(test_data_dir)
-    import compose
-    tmpdir = tempfile.mkdtemp()
-    try:
-      # First make sure the simple pipeline can be compiled.
-      simple_package_path = os.path.join(tmpdir, 'simple.zip')
-      compiler.Compiler().compile(compose.save_most_frequent_word, simple_package_path)
-
-      # Then make sure the composed pipeline can be compiled and also compare with golden.
-      compose_package_path = os.path.join(tmpdir, 'compose.zip')
-      compiler.Compiler().compile(compose.download_save_most_frequent_word, compose_package_path)
-      with open(os.path.join(test_data_dir, 'compose.yaml'), 'r') as f:
-        golden = yaml.safe_load(f)
-      compiled = self._get_yaml_from_zip(compose_package_path)
-
-      self.maxDiff = None
-      # Comment next line for generating golden yaml.
-      self.assertEqual(golden, compiled)
-    finally:
-      # Replace next line with commented line for gathering golden yaml.
-      shutil.rmtree(tmpdir)
-      # print(tmpdir)
+    # First make sure the simple pipeline can be compiled.
+    compiler.Compiler()._compile(self._compose.save_most_frequent_word)
+
+    # Then make sure the composed pipeline can be compiled and also compare with golden.
+    compiled = compiler.Compiler()._compile(self._compose.download_save_most_frequent_word)
+    golden = self._load_golden(os.path.join(_TEST_DATA_DIR, 'compose.yaml'))
+
+    self.maxDiff = None
+    self.assertEqual(golden, compiled)
+
+  def _unload_modules(self, name):
+    # Drop any copy imported by an earlier test, so that the pipeline decorators
+    # run again under the collector set up by the compile entry points.
+    for module_name in list(sys.modules):
+      if module_name == name or module_name.startswith(name + '.'):
+        del sys.modules[module_name]
 
   def test_package_compile(self):
     """Test compiling python packages."""
 
-    test_data_dir = os.path.join(os.path.dirname(__file__), 'testdata')
-    test_package_dir = os.path.join(test_data_dir, 'testpackage')
-    tmpdir = tempfile.mkdtemp()
-    cwd = os.getcwd()
+    test_package_dir = os.path.join(_TEST_DATA_DIR, 'testpackage')
+    tmpdir = self._make_tmpdir()
+    subprocess.check_call(['python3', 'setup.py', 'sdist', '--format=gztar', '-d', tmpdir],
+                          cwd=test_package_dir)
+    package_path = os.path.join(tmpdir, 'testsample-0.1.tar.gz')
+    target_zip = os.path.join(tmpdir, 'compose.zip')
+    self._unload_modules('mypipeline')
     try:
-      os.chdir(test_package_dir)
-      subprocess.check_call(['python3', 'setup.py', 'sdist', '--format=gztar', '-d', tmpdir])
-      package_path = os.path.join(tmpdir, 'testsample-0.1.tar.gz')
-      target_zip = os.path.join(tmpdir, 'compose.zip')
-      subprocess.check_call([
-          'dsl-compile', '--package', package_path, '--namespace', 'mypipeline',
-          '--output', target_zip, '--function', 'download_save_most_frequent_word'])
-      with open(os.path.join(test_data_dir, 'compose.yaml'), 'r') as f:
-        golden = yaml.safe_load(f)
-      compiled = self._get_yaml_from_zip(target_zip)
-
-      self.maxDiff = None
-      self.assertEqual(golden, compiled)
+      compiler_main.compile_package(
+          package_path, 'mypipeline', 'download_save_most_frequent_word', target_zip, True)
     finally:
-      shutil.rmtree(tmpdir)
-      os.chdir(cwd)
+      self._unload_modules('mypipeline')
+    golden = self._load_golden(os.path.join(_TEST_DATA_DIR, 'compose.yaml'))
+    compiled = self._get_yaml_from_zip(target_zip)
 
-  def _test_py_compile_zip(self, file_base_name):
-    test_data_dir = os.path.join(os.path.dirname(__file__), 'testdata')
-    py_file = os.path.join(test_data_dir, file_base_name + '.py')
-    tmpdir = tempfile.mkdtemp()
-    try:
-      target_zip = os.path.join(tmpdir, file_base_name + '.zip')
-      subprocess.check_call([
-          'dsl-compile', '--py', py_file, '--output', target_zip])
-      with open(os.path.join(test_data_dir, file_base_name + '.yaml'), 'r') as f:
-        golden = yaml.safe_load(f)
-      compiled = self._get_yaml_from_zip(target_zip)
-
-      self.maxDiff = None
-      self.assertEqual(golden, compiled)
-    finally:
-      shutil.rmtree(tmpdir)
-
-  def _test_py_compile_targz(self, file_base_name):
-    test_data_dir = os.path.join(os.path.dirname(__file__), 'testdata')
-    py_file = os.path.join(test_data_dir, file_base_name + '.py')
-    tmpdir = tempfile.mkdtemp()
-    try:
-      target_tar = os.path.join(tmpdir, file_base_name + '.tar.gz')
-      subprocess.check_call([
-          'dsl-compile', '--py', py_file, '--output', target_tar])
-      with open(os.path.join(test_data_dir, file_base_name + '.yaml'), 'r') as f:
-        golden = yaml.safe_load(f)
-      compiled = self._get_yaml_from_tar(target_tar)
-      self.maxDiff = None
-      self.assertEqual(golden, compiled)
-    finally:
-      shutil.rmtree(tmpdir)
+    self.maxDiff = None
+    self.assertEqual(golden, compiled)
 
-  def _test_py_compile_yaml(self, file_base_name):
-    test_data_dir = os.path.join(os.path.dirname(__file__), 'testdata')
-    py_file = os.path.join(test_data_dir, file_base_name + '.py')
-    tmpdir = tempfile.mkdtemp()
-    try:
-      target_yaml = os.path.join(tmpdir, file_base_name + '-pipeline.yaml')
-      subprocess.check_call([
-          'dsl-compile', '--py', py_file, '--output', target_yaml])
-      with open(os.path.join(test_data_dir, file_base_name + '.yaml'), 'r') as f:
-        golden = yaml.safe_load(f)
+  def _compile_pyfile(self, py_file, output_path):
+    self._unload_modules(os.path.splitext(os.path.basename(py_file))[0])
+    compiler_main.compile_pyfile(py_file, None, output_path, True)
 
-      with open(os.path.join(test_data_dir, target_yaml), 'r') as f:
-        compiled = yaml.safe_load(f)
+  def _test_py_compile(self, file_base_name, ext):
+    loaders = {
+        'zip': self._get_yaml_from_zip,
+        'tar.gz': self._get_yaml_from_tar,
+        'yaml': self._get_yaml_from_file,
+    }
+    py_file = os.path.join(_TEST_DATA_DIR, file_base_name + '.py')
+    tmpdir = self._make_tmpdir()
+    target = os.path.join(tmpdir, file_base_name + '-pipeline.' + ext)
+    self._compile_pyfile(py_file, target)
+    golden = self._load_golden(os.path.join(_TEST_DATA_DIR, file_base_name + '.yaml'))
+    compiled = loaders[ext](target)
 
-      self.maxDiff = None
-      self.assertEqual(golden, compiled)
-    finally:
-      shutil.rmtree(tmpdir)
+    self.maxDiff = None
+    self.assertEqual(golden, compiled)
 
   def test_py_compile_artifact_location(self):
     """Test configurable artifact location pipeline."""
-    self._test_py_compile_yaml('artifact_location')
+    self._test_py_compile('artifact_location', 'yaml')
 
   def test_py_compile_basic(self):
     """Test basic sequential pipeline."""
-    self._test_py_compile_zip('basic')
+    self._test_py_compile('basic', 'zip')
 
   def test_py_compile_with_sidecar(self):
     """Test pipeline with sidecar."""
-    self._test_py_compile_yaml('sidecar')
+    self._test_py_compile('sidecar', 'yaml')
 
   def test_py_compile_with_pipelineparams(self):
     """Test pipeline with multiple pipeline params."""
-    self._test_py_compile_yaml('pipelineparams')
+    self._test_py_compile('pipelineparams', 'yaml')
 
   def test_py_compile_condition(self):
     """Test a pipeline with conditions."""
-    self._test_py_compile_zip('coin')
+    self._test_py_compile('coin', 'zip')
 
   def test_py_compile_immediate_value(self):
     """Test a pipeline with immediate value parameter."""
-    self._test_py_compile_targz('immediate_value')
+    self._test_py_compile('immediate_value', 'tar.gz')
 
   def test_py_compile_default_value(self):
     """Test a pipeline with a parameter with default value."""
-    self._test_py_compile_targz('default_value')
+    self._test_py_compile('default_value', 'tar.gz')
 
   def test_py_volume(self):
     """Test a pipeline with a volume and volume mount."""
-    self._test_py_compile_yaml('volume')
+    self._test_py_compile('volume', 'yaml')
 
   def test_py_retry(self):
     """Test retry functionality."""
-    self._test_py_compile_yaml('retry')
+    self._test_py_compile('retry', 'yaml')
 
   def test_py_image_pull_secret(self):
     """Test pipeline imagepullsecret."""
-    self._test_py_compile_yaml('imagepullsecret')
+    self._test_py_compile('imagepullsecret', 'yaml')
 
   def test_py_timeout(self):
     """Test pipeline timeout."""
-    self._test_py_compile_yaml('timeout')
+    self._test_py_compile('timeout', 'yaml')
 
   def test_py_recursive_do_while(self):
     """Test pipeline recursive."""
-    self._test_py_compile_yaml('recursive_do_while')
+    self._test_py_compile('recursive_do_while', 'yaml')
 
   def test_py_recursive_while(self):
     """Test pipeline recursive."""
-    self._test_py_compile_yaml('recursive_while')
+    self._test_py_compile('recursive_while', 'yaml')
 
   def test_py_resourceop_basic(self):
     """Test pipeline resourceop_basic."""
-    self._test_py_compile_yaml('resourceop_basic')
+    self._test_py_compile('resourceop_basic', 'yaml')
 
   def test_py_volumeop_basic(self):
     """Test pipeline volumeop_basic."""
-    self._test_py_compile_yaml('volumeop_basic')
+    self._test_py_compile('volumeop_basic', 'yaml')
 
   def test_py_volumeop_parallel(self):
     """Test pipeline volumeop_parallel."""
-    self._test_py_compile_yaml('volumeop_parallel')
+    self._test_py_compile('volumeop_parallel', 'yaml')
 
   def test_py_volumeop_dag(self):
     """Test pipeline volumeop_dag."""
-    self._test_py_compile_yaml('volumeop_dag')
+    self._test_py_compile('volumeop_dag', 'yaml')
 
   def test_py_volume_snapshotop_sequential(self):
     """Test pipeline volume_snapshotop_sequential."""
-    self._test_py_compile_yaml('volume_snapshotop_sequential')
+    self._test_py_compile('volume_snapshotop_sequential', 'yaml')
 
   def test_py_volume_snapshotop_rokurl(self):
     """Test pipeline volumeop_sequential."""
-    self._test_py_compile_yaml('volume_snapshotop_rokurl')
+    self._test_py_compile('volume_snapshotop_rokurl', 'yaml')
 
   def test_py_volumeop_sequential(self):
     """Test pipeline volumeop_sequential."""
-    self._test_py_compile_yaml('volumeop_sequential')
+    self._test_py_compile('volumeop_sequential', 'yaml')
 
   def test_py_param_substitutions(self):
     """Test pipeline param_substitutions."""
-    self._test_py_compile_yaml('param_substitutions')
+    self._test_py_compile('param_substitutions', 'yaml')
 
   def test_py_param_op_transform(self):
     """Test pipeline param_op_transform."""
-    self._test_py_compile_yaml('param_op_transform')
+    self._test_py_compile('param_op_transform', 'yaml')
 
   def test_type_checking_with_consistent_types(self):
     """Test type check pipeline parameters against component metadata."""
@@ -390,15 +376,9 @@ class TestCompiler(unittest.TestCase):
     def my_pipeline(a: {'GCSPath': {'path_type':'file', 'file_type': 'tsv'}}='good', b: Integer()=12):
       a_op(field_m=a, field_o=b)
 
-    test_data_dir = os.path.join(os.path.dirname(__file__), 'testdata')
-    sys.path.append(test_data_dir)
-    tmpdir = tempfile.mkdtemp()
-    try:
-      simple_package_path = os.path.join(tmpdir, 'simple.tar.gz')
-      compiler.Compiler().compile(my_pipeline, simple_package_path, type_check=True)
-
-    finally:
-      shutil.rmtree(tmpdir)
+    tmpdir = self._make_tmpdir()
+    simple_package_path = os.path.join(tmpdir, 'simple.tar.gz')
+    compiler.Compiler().compile(my_pipeline, simple_package_path, type_check=True)
 
   def test_type_checking_with_inconsistent_types(self):
     """Test type check pipeline parameters against component metadata."""
@@ -420,17 +400,11 @@ class TestCompiler(unittest.TestCase):
     def my_pipeline(a: {'GCSPath': {'path_type':'file', 'file_type': 'csv'}}='good', b: Integer()=12):
       a_op(field_m=a, field_o=b)
 
-    test_data_dir = os.path.join(os.path.dirname(__file__), 'testdata')
-    sys.path.append(test_data_dir)
-    tmpdir = tempfile.mkdtemp()
-    try:
-      simple_package_path = os.path.join(tmpdir, 'simple.tar.gz')
-      with self.assertRaises(InconsistentTypeException):
-        compiler.Compiler().compile(my_pipeline, simple_package_path, type_check=True)
-      compiler.Compiler().compile(my_pipeline, simple_package_path, type_check=False)
-
-    finally:
-      shutil.rmtree(tmpdir)
+    tmpdir = self._make_tmpdir()
+    simple_package_path = os.path.join(tmpdir, 'simple.tar.gz')
+    with self.assertRaises(InconsistentTypeException):
+      compiler.Compiler().compile(my_pipeline, simple_package_path, type_check=True)
+    compiler.Compiler().compile(my_pipeline, simple_package_path, type_check=False)
 
   def test_type_checking_with_json_schema(self):
     """Test type check pipeline parameters against the json schema."""
@@ -452,17 +426,11 @@ class TestCompiler(unittest.TestCase):
     def my_pipeline(a: {'GCRPath': {'openapi_schema_validator': {"type": "string", "pattern": "^.*gcr\\.io/.*$"}}}='good', b: 'Integer'=12):
       a_op(field_m=a, field_o=b)
 
-    test_data_dir = os.path.join(os.path.dirname(__file__), 'testdata')
-    sys.path.append(test_data_dir)
-    tmpdir = tempfile.mkdtemp()
-    try:
-      simple_package_path = os.path.join(tmpdir, 'simple.tar.gz')
-      import jsonschema
-      with self.assertRaises(jsonschema.exceptions.ValidationError):
-        compiler.Compiler().compile(my_pipeline, simple_package_path, type_check=True)
-
-    finally:
-      shutil.rmtree(tmpdir)
+    tmpdir = self._make_tmpdir()
+    simple_package_path = os.path.join(tmpdir, 'simple.tar.gz')
+    import jsonschema
+    with self.assertRaises(jsonschema.exceptions.ValidationError):
+      compiler.Compiler().compile(my_pipeline, simple_package_path, type_check=True)
 
   def test_compile_pipeline_with_after(self):
     def op():
@@ -479,10 +447,9 @@ class TestCompiler(unittest.TestCase):
     compiler.Compiler()._compile(pipeline)
 
   def _test_op_to_template_yaml(self, ops, file_base_name):
-    test_data_dir = os.path.join(os.path.dirname(__file__), 'testdata')
-    target_yaml = os.path.join(test_data_dir, file_base_name + '.yaml')
+    target_yaml = os.path.join(_TEST_DATA_DIR, file_base_name + '.yaml')
     with open(target_yaml, 'r') as f:
-      expected = yaml.safe_load(f)['spec']['templates'][0]
+      expected = _safe_load(f)['spec']['templates'][0]
 
     compiled_template = compiler._op_to_template._op_to_template(ops)
 
@@ -509,7 +476,6 @@ class TestCompiler(unittest.TestCase):
   def test_set_display_name(self):
     """Test a pipeline with a customized task names."""
 
-    import kfp
     op1 = kfp.components.load_component_from_text(
       '''
 name: Component name
@@ -551,7 +517,7 @@ implementation:
         self.assertEqual(template['retryStrategy']['limit'], 5)
 
   def test_add_pod_env(self):
-    self._test_py_compile_yaml('add_pod_env')
+    self._test_py_compile('add_pod_env', 'yaml')
 
   def test_init_container(self):
     echo = dsl.UserContainer(